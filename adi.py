@@ -7,12 +7,17 @@ import datetime
 import numpy as np
 from typing import Tuple
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+mixed_precision.set_global_policy('mixed_float16')
 import keras.backend as K
 from keras import optimizers
-from keras.layers import Input, Dense, Flatten
+from keras.layers import Input, Dense, Flatten, Lambda
 from keras.models import Model
 from keras.models import model_from_json
-from rubiks_cube import RubiksCube, RubiksAction
+from rubiks_cube import RubiksCube, get_face_permutations, get_one_hot_permutations
+from adi_kernels import scramble_batch
+from shuffle_utils import threaded_block_shuffle
 
 
 class ADI(object):
@@ -91,47 +96,85 @@ class ADI(object):
             "Dataset file name incorrect"
         _, dim, k, l = [int(digit) for digit in numbers_parsed]
         self.logger.info("dim={0}, k={1}, l={2}".format(dim, k, l))
-        X = np.load('data' + os.path.sep + self.load_files[0])
-        weights = np.load('data' + os.path.sep + self.load_files[1])
+        X = np.load('data' + os.path.sep + self.load_files[0], mmap_mode='r')
+        weights = np.load('data' + os.path.sep + self.load_files[1], mmap_mode='r')
         return dim, k, l, X, weights
 
-    def _generate_dataset(self, k: int = 25, l: int = 40000, save_dataset: bool = True
-                          ) -> Tuple[np.ndarray, np.ndarray]:
+    def _action_tables(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Sticker permutation and inverse-action index tables for the configured cube dimension
+        Both are built lazily by rubiks_cube and shared across all users of the same dimension
+        :return: (permutations, inverse_indexes) of shapes (actions_number, state_size) and (actions_number,)
+        """
+        return get_face_permutations(self.cube_dim), RubiksCube.get_inverse_action_indexes()
+
+    def _scramble_batch(self, l: int, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Simulate l independent scramble sequences of length k with the compiled parallel kernel
+        Each sequence applies one permutation table lookup per scramble step instead of a
+        RubiksCube step, and the inverse of the previous action is masked out as before
+        :param k: Number of scrambles from the solved state to generate a sequence of cubes
+        :param l: Number of sequences generated
+        :return: (states, actions) of shapes (l, k, state_size) and (l, k)
+        """
+        permutations, inverse_indexes = self._action_tables()
+        solved = RubiksCube(dim=self.cube_dim).state.reshape(-1).astype(np.int8)
+        seeds = np.random.randint(0, 2 ** 31 - 1, size=l)
+        return scramble_batch(l, k, permutations, inverse_indexes, solved, seeds)
+
+    def _one_hot_states(self, states: np.ndarray, dtype: type = np.float32) -> np.ndarray:
+        """
+        One-hot encode a batch of flattened sticker states into the model input layout
+        The output array is preallocated once and filled in place
+        :param states: Integer sticker states of shape (samples, state_size)
+        :param dtype: Output dtype, float32 for model inputs or uint8 for compact storage
+        :return: One-hot encoded states of shape (samples,) + state_one_hot.shape
+        """
+        rubiks_cube = RubiksCube(dim=self.cube_dim)
+        one_hot = np.empty(states.shape + (len(rubiks_cube.colors),), dtype=dtype)
+        np.take(np.eye(len(rubiks_cube.colors), dtype=dtype), states, axis=0, out=one_hot)
+        return one_hot.reshape((states.shape[0],) + rubiks_cube.state_one_hot.shape)
+
+    def _generate_dataset(self, k: int = 25, l: int = 40000, save_dataset: bool = True,
+                          l_chunk: int = 2048) -> Tuple[np.ndarray, np.ndarray]:
         """
         Dataset generation private method
         Some parameters are passed here to make possible online dataset generation in the train method
+        Sequences are generated l_chunk at a time and streamed into the output arrays, so peak
+        memory stays bounded by the chunk size; when saving, the output is a memory-mapped npy
+        file and the full dataset only ever exists on disk. The sample order is then shuffled
+        in place by the threaded block shuffle
         :param k: Number of scrambles from the solved state to generate a sequence of cubes
         :param l: Number of sequences generated
         :param save_dataset: Boolean for saving or not the created dataset
+        :param l_chunk: Number of sequences generated and flushed per chunk
         :return: (X, weights)
         """
         self.logger.info("Generating dataset...")
-        X, weights = [], []
-        for iteration in range(l):
-            rubiks_cube = RubiksCube(dim=self.cube_dim, shuffle=False, verbose=False)
-            inverse_previous_action_idx = None
-            for shuffle in range(k):
-                action_idx = random.choice(
-                    [idx for idx in range(len(rubiks_cube.actions)) if idx != inverse_previous_action_idx]
-                )
-                action = RubiksAction(rubiks_cube.actions[action_idx])
-                rubiks_cube.step(action)
-                inverse_previous_action_idx = rubiks_cube.index_actions[str(action.get_inverse_action())]
-                weight = 1 / (shuffle + 1)
-                X.append(rubiks_cube.state_one_hot)
-                weights.append(weight)
-            if self.verbose and iteration % (l / 10) == 0:
-                self.logger.info("{0:.2f}%".format((iteration / l) * 100))
-        X, weights = np.asarray(X), np.asarray(weights)
-        if self.shuffle:
-            random_indexes = np.random.permutation(range(l * k))
-            X, weights = X[random_indexes], weights[random_indexes]
+        rubiks_cube = RubiksCube(dim=self.cube_dim)
+        samples_shape = (l * k,) + rubiks_cube.state_one_hot.shape
         os.makedirs('data', exist_ok=True)
         if save_dataset:
             samples_file = "data/scrambled_cubes_{0}x{0}_k{1}_l{2}.npy".format(self.cube_dim, k, l)
             weights_file = "data/weights_{0}x{0}_k{1}_l{2}.npy".format(self.cube_dim, k, l)
-            np.save(samples_file, X)
-            np.save(weights_file, weights)
+            X = np.lib.format.open_memmap(samples_file, mode='w+', dtype=np.uint8, shape=samples_shape)
+            weights = np.lib.format.open_memmap(weights_file, mode='w+', dtype=np.float32, shape=(l * k,))
+        else:
+            X = np.empty(samples_shape, dtype=np.uint8)
+            weights = np.empty(l * k, dtype=np.float32)
+        sequence_weights = 1.0 / np.arange(1, k + 1, dtype=np.float32)
+        for start in range(0, l, l_chunk):
+            stop = min(start + l_chunk, l)
+            states, _ = self._scramble_batch(stop - start, k)
+            X[start * k:stop * k] = self._one_hot_states(
+                states.reshape((stop - start) * k, -1), dtype=np.uint8
+            )
+            weights[start * k:stop * k] = np.tile(sequence_weights, stop - start)
+        if self.shuffle:
+            threaded_block_shuffle(X, weights)
+        if save_dataset:
+            X.flush()
+            weights.flush()
         return X, weights
 
     def _design_model(self) -> Model:
@@ -141,21 +184,37 @@ class ADI(object):
         x = Flatten()(inputs)
         x = Dense(4096, activation='elu')(x)
         x = Dense(2048, activation='elu')(x)
-        pre_v = Dense(512, activation='elu')(x)
-        pre_p = Dense(512, activation='elu')(x)
-        v = Dense(1, activation='linear', name='value_output')(pre_v)
-        p = Dense(12, activation='softmax', name='policy_output')(pre_p)
+        pre_heads = Dense(1024, activation='elu')(x)
+        pre_v = Lambda(lambda t: t[:, :512])(pre_heads)
+        pre_p = Lambda(lambda t: t[:, 512:])(pre_heads)
+        v = Dense(1, activation='linear', name='value_output', dtype='float32')(pre_v)
+        p = Dense(12, activation='softmax', name='policy_output', dtype='float32')(pre_p)
 
         losses = {
             'value_output': 'mean_squared_error',
-            'policy_output': 'categorical_crossentropy'
+            'policy_output': 'sparse_categorical_crossentropy'
         }
         opt = optimizers.Adam(lr=self.initial_lr)
 
         model = Model(inputs=inputs, outputs=[v, p])
         model.compile(optimizer=opt, loss=losses)
+        self._infer = self._build_infer_function(model)
         return model
 
+    @staticmethod
+    def _build_infer_function(model: Model):
+        """
+        Build a graph-compiled forward pass bypassing the predict dispatch machinery
+        Model.predict pays for its data adapter, callbacks and batching logic on every call,
+        which dominates for batches already sitting in memory
+        :param model: Compiled model to run inference on
+        :return: tf.function computing model(x, training=False)
+        """
+        @tf.function(reduce_retracing=True)
+        def _infer(x):
+            return model(x, training=False)
+        return _infer
+
     def save_trained_model(self, filename: str) -> None:
         """
         Save the trained model in local
@@ -181,16 +240,18 @@ class ADI(object):
         loaded_model.load_weights(model_name_h5)
         losses = {
             'value_output': 'mean_squared_error',
-            'policy_output': 'categorical_crossentropy'
+            'policy_output': 'sparse_categorical_crossentropy'
         }
         loaded_model.compile(optimizer='rmsprop', loss=losses)
         self.model = loaded_model
+        self._infer = self._build_infer_function(loaded_model)
         self.current_iteration = current_iteration
 
     def train(self, generate_online_dataset: bool = False,
               k: int = None, l: int = None,
               lr_decay: bool = True, lr_decay_gamma: float = 0.95, lr_decay_freq = 1000,
               batch_size: int = 1000, batches_number: int = 5, epochs_per_batch: int = 1,
+              fit_batch_size: int = 32,
               save_frequency: int = 10, log_frequency: int = 5) -> None:
         """
         :param generate_online_dataset: If true, generate its own dataset for each batch
@@ -202,12 +263,15 @@ class ADI(object):
         :param batch_size: Number of cubes for a batch for one pass, only used if generate_online_dataset is False
         :param batches_number: Number of total epochs
         :param epochs_per_batch: Number of epochs for one batch
+        :param fit_batch_size: Size of the mini-batches fed to the model by the input pipeline
         :param save_frequency: Number of batches between each saving
         :param log_frequency: Number of batches between each logging
         :return: None
         """
         self.logger.info("Training model...")
         rubiks_cube = RubiksCube(dim=self.cube_dim)
+        one_hot_permutations = get_one_hot_permutations(self.cube_dim)
+        solved_one_hot = rubiks_cube.state_one_hot.reshape(-1)
         for _ in range(batches_number):
             self.current_iteration += 1
             self.logger.info("Batch number: {0}".format(self.current_iteration))
@@ -218,26 +282,21 @@ class ADI(object):
             else:
                 assert self.X is not None and self.weights is not None
                 k, l = self.k, self.l
-                batch_indexes = np.random.choice(range(len(self.X)), size=batch_size, replace=False)
+                batch_indexes = np.random.choice(len(self.X), size=batch_size, replace=False)
                 X_batch, weights_batch = self.X[batch_indexes], self.weights[batch_indexes]
-            rewards, states = [], []
-            for X_i in X_batch:
-                rewards_i, states_i = [], []
-                for action in rubiks_cube.actions:
-                    states_a, reward_a, _, _ = RubiksCube(dim=self.cube_dim, cube=X_i).step(RubiksAction(action))
-                    rewards_i.append(reward_a)
-                    states_i.append(RubiksCube.to_one_hot_cube(states_a))
-                rewards.append(np.asarray(rewards_i))
-                states.append(np.asarray(states_i))
-
-            rewards, states = np.asarray(rewards), np.asarray(states)
-            states = states.reshape(-1, *states.shape[2:])
+            X_batch = X_batch.astype(np.float32, copy=False)
+            successors = X_batch.reshape(batch_size, -1)[:, one_hot_permutations]
+            solved = (successors == solved_one_hot).all(axis=-1)
+            rewards = np.where(solved, 1.0, -1.0)
+            states = successors.reshape((-1,) + X_batch.shape[1:])
 
-            (values, _) = self.model.predict(states)
-            values = values.reshape((batch_size, len(rubiks_cube.actions)))
+            (values, _) = self._infer(states)
+            values = np.asarray(values).reshape((batch_size, len(rubiks_cube.actions)))
 
-            Y_v = np.max(rewards + values, axis=1)
-            Y_p = np.eye(len(rubiks_cube.actions))[np.argmax(rewards + values, axis=1)]
+            q_values = rewards + values
+            best_actions = np.argmax(q_values, axis=1)
+            Y_v = q_values[np.arange(q_values.shape[0]), best_actions]
+            Y_p = best_actions.astype(np.int32)
 
             if lr_decay:
                 if self.current_iteration%lr_decay_freq == 0:
@@ -246,12 +305,12 @@ class ADI(object):
                     K.set_value(self.model.optimizer.lr, new_lr)
                     self.logger.info("Changed LR from {0:.3E} to {1:.3E}".format(current_lr, new_lr))
 
-            history = self.model.fit(
+            dataset = tf.data.Dataset.from_tensor_slices((
                 {'input': X_batch},
                 {'policy_output': Y_p, 'value_output': Y_v},
-                sample_weight={'policy_output': weights_batch, 'value_output': weights_batch},
-                epochs=epochs_per_batch
-            )
+                {'policy_output': weights_batch, 'value_output': weights_batch}
+            )).batch(fit_batch_size).prefetch(tf.data.AUTOTUNE)
+            history = self.model.fit(dataset, epochs=epochs_per_batch)
             loss = history.history['loss'][-1]
             if self.save_log:
                 if self.current_iteration%log_frequency == 0:
@@ -259,9 +318,7 @@ class ADI(object):
                     now = datetime.datetime.today().strftime('%Y-%m-%d')
                     filename = 'log/{0}.log'.format(now)
                     precision_iter = 500
-                    acc = np.mean([
-                        self.estimate_naive_accuracy(depth=i, iterations=precision_iter) for i in range(1, k+1)
-                    ])
+                    acc = np.mean(self.estimate_naive_accuracies(max_depth=k, iterations=precision_iter))
                     s_log = '{0} - epochs{1}_bs{2}_dim{3}x{3}_k{4}_l{5}_lr{6:.1E}_iter{7}: loss={8:.5f}, acc={9:.5f}\n'
                     with open(filename, 'a') as f:
                         f.write(
@@ -279,24 +336,27 @@ class ADI(object):
                     )
                     self.save_trained_model(filename)
 
+    def estimate_naive_accuracies(self, max_depth: int, iterations: int) -> np.ndarray:
+        """
+        Estimate the naive accuracy for every scramble depth from 1 to max_depth at once
+        The intermediate states of a depth max_depth scramble are themselves scrambles of every
+        lower depth, so a single batched predict call covers all depths together
+        :param max_depth: Maximum scramble depth in the accuracy approximation
+        :param iterations: Number of iterations, a higher value leads to a better accuracy approximation
+        :return: Array of max_depth approximated accuracies, one per depth
+        """
+        _, inverse_indexes = self._action_tables()
+        states, actions = self._scramble_batch(iterations, max_depth)
+        all_states = self._one_hot_states(states.reshape(iterations * max_depth, -1))
+        (_, p) = self._infer(all_states)
+        predictions = np.argmax(np.asarray(p), axis=1).reshape(iterations, max_depth)
+        expected_inverse_idx = inverse_indexes[actions]
+        return (predictions == expected_inverse_idx).mean(axis=0)
+
     def estimate_naive_accuracy(self, depth: int, iterations: int) -> float:
         """
         :param depth: Maximum scramble depth in the accuracy approximation
         :param iterations: Number of iterations, a higher value leads to a better accuracy approximation
         :return: Approximated accuracy
         """
-        score = 0
-        for iteration in range(iterations):
-            rubiks = RubiksCube(dim=self.cube_dim, shuffle=False)
-            inverse_previous_action_idx = None
-            for depth_i in range(depth):
-                action_idx = random.choice(
-                    [idx for idx in range(len(rubiks.actions)) if idx != inverse_previous_action_idx]
-                )
-                action = RubiksAction(rubiks.actions[action_idx])
-                rubiks.step(action)
-                inverse_previous_action_idx = rubiks.index_actions[str(action.get_inverse_action())]
-            (_, p) = self.model.predict(np.expand_dims(rubiks.state_one_hot, axis=0))
-            prediction = np.argmax(p)
-            score += prediction == inverse_previous_action_idx
-        return score/iterations
+        return float(self.estimate_naive_accuracies(depth, iterations)[-1])
@@ -0,0 +1,36 @@
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True, parallel=True, boundscheck=False)
+def scramble_batch(l, k, permutations, inverse_indexes, solved, seeds):
+    """
+    Simulate l independent scramble sequences of length k, parallelized over sequences
+    Each sequence runs on its own thread with its own seed, applying one permutation
+    table lookup per scramble step and never sampling the inverse of the previous action
+    :param l: Number of sequences generated
+    :param k: Number of scrambles from the solved state to generate a sequence of cubes
+    :param permutations: Per-action sticker permutation tables, shape (actions_number, state_size)
+    :param inverse_indexes: Index of the inverse of each action, shape (actions_number,)
+    :param solved: Flattened solved cube state, shape (state_size,)
+    :param seeds: Per-sequence random seeds, shape (l,)
+    :return: (states, actions) of shapes (l, k, state_size) and (l, k)
+    """
+    actions_number, state_size = permutations.shape
+    states = np.empty((l, k, state_size), dtype=solved.dtype)
+    actions = np.empty((l, k), dtype=np.int64)
+    for i in prange(l):
+        np.random.seed(seeds[i])
+        state = solved.copy()
+        inverse_previous = -1
+        for shuffle in range(k):
+            if inverse_previous < 0:
+                action_idx = np.random.randint(0, actions_number)
+            else:
+                action_idx = np.random.randint(0, actions_number - 1)
+                action_idx += action_idx >= inverse_previous
+            state = state[permutations[action_idx]]
+            states[i, shuffle] = state
+            actions[i, shuffle] = action_idx
+            inverse_previous = inverse_indexes[action_idx]
+    return states, actions
@@ -1,98 +1,100 @@
 import numpy as np
 import math
-import collections
 from typing import Optional, List, Tuple
 
-from rubiks_cube import RubiksCube, RubiksAction
+from rubiks_cube import RubiksCube
 from adi import ADI
 
 
-class RootNode:
-    def __init__(self):
+class UCTTree:
+    def __init__(self, root_state: np.ndarray, actions_number: int, max_nodes: int) -> None:
         """
-        MCTS Root node, can be considered as the virtual parent of the main UCTNode
-        """
-        self.parent = None
-        self.child_total_value = collections.defaultdict(float)
-        self.child_number_visits = collections.defaultdict(float)
-
-
-class UCTNode:
-    def __init__(self, game_state: np.ndarray, move: Optional[int], actions_number: int, parent=None) -> None:
-        """
-        Node object of the MCTS
-        :param game_state: State of the rubik's cube associated to the node
-        :param move: Last move that has led to the current state of the node
+        Struct-of-arrays storage for the MCTS search tree
+        Every per-node and per-child statistic lives in a preallocated NumPy array indexed by
+        node id, so child selection is one vectorized expression over all moves of a node
+        instead of per-child Python objects and attribute lookups
+        :param root_state: One-hot state of the cube at the root of the tree
         :param actions_number: Number of actions possible
-        :param parent: Parent UCTNode
+        :param max_nodes: Maximum number of nodes the search can allocate, the root included
         :return None
         """
-        self.game_state = game_state
-        self.move = move
         self.actions_number = actions_number
-        self.is_expanded = False
-        self.parent = parent
-        self.children = {}
-        self.child_priors = np.zeros(actions_number, dtype=np.float32)
-        self.child_total_value = np.zeros(actions_number, dtype=np.float32)
-        self.child_number_visits = np.zeros(actions_number, dtype=np.float32)
-
-    @property
-    def number_visits(self) -> int:
-        return self.parent.child_number_visits[self.move]
-
-    @number_visits.setter
-    def number_visits(self, value: int) -> None:
-        self.parent.child_number_visits[self.move] = value
-
-    @property
-    def total_value(self) -> float:
-        return self.parent.child_total_value[self.move]
-
-    @total_value.setter
-    def total_value(self, value: int) -> None:
-        self.parent.child_total_value[self.move] = value
-
-    def child_Q(self) -> np.ndarray:
-        return self.child_total_value / (1 + self.child_number_visits)
-
-    def child_U(self) -> np.ndarray:
-        return math.sqrt(self.number_visits) * (self.child_priors /
-                                                (1 + self.child_number_visits))
-
-    def best_child(self) -> int:
-        return np.argmax(self.child_Q() + self.child_U())
-
-    def select_leaf(self) -> Tuple['UCTNode', List]:
+        self.max_nodes = max_nodes
+        self.game_states = np.empty((max_nodes,) + root_state.shape, dtype=root_state.dtype)
+        self.child_priors = np.zeros((max_nodes, actions_number), dtype=np.float32)
+        self.child_total_value = np.zeros((max_nodes, actions_number), dtype=np.float32)
+        self.child_number_visits = np.zeros((max_nodes, actions_number), dtype=np.float32)
+        self.children = np.full((max_nodes, actions_number), -1, dtype=np.int32)
+        self.parents = np.full(max_nodes, -1, dtype=np.int32)
+        self.parent_moves = np.full(max_nodes, -1, dtype=np.int8)
+        self.is_expanded = np.zeros(max_nodes, dtype=np.bool_)
+        self.root_total_value = 0.0
+        self.root_number_visits = 0.0
+        self.game_states[0] = root_state
+        self.next_free = 1
+        self.scratch_cube = RubiksCube(dim=root_state.shape[1])
+
+    def number_visits(self, node: int) -> float:
+        parent = self.parents[node]
+        if parent < 0:
+            return self.root_number_visits
+        return self.child_number_visits[parent, self.parent_moves[node]]
+
+    def _add_virtual_visit(self, node: int) -> None:
+        parent = self.parents[node]
+        if parent < 0:
+            self.root_number_visits += 1
+            self.root_total_value -= 1
+        else:
+            move = self.parent_moves[node]
+            self.child_number_visits[parent, move] += 1
+            self.child_total_value[parent, move] -= 1
+
+    def best_child(self, node: int) -> int:
+        sqrt_parent_visits = math.sqrt(self.number_visits(node))
+        scores = (self.child_total_value[node] + sqrt_parent_visits * self.child_priors[node]) \
+            / (1 + self.child_number_visits[node])
+        return int(np.argmax(scores))
+
+    def maybe_add_child(self, node: int, move: int) -> int:
+        child = self.children[node, move]
+        if child < 0:
+            self.scratch_cube.load_state(self.game_states[node])
+            state_child, _, _, _ = self.scratch_cube.fast_step(move)
+            child = self.next_free
+            self.next_free += 1
+            self.game_states[child] = RubiksCube.to_one_hot_cube(state_child)
+            self.children[node, move] = child
+            self.parents[child] = node
+            self.parent_moves[child] = move
+        return int(child)
+
+    def select_leaf(self) -> Tuple[int, List]:
         path = []
-        current = self
-        while current.is_expanded:
-            current.number_visits += 1
-            current.total_value -= 1
-            best_action = current.best_child()
+        current = 0
+        while self.is_expanded[current]:
+            self._add_virtual_visit(current)
+            best_action = self.best_child(current)
             path.append(best_action)
-            current = current.maybe_add_child(best_action)
+            current = self.maybe_add_child(current, best_action)
         return current, path
 
-    def expand(self, child_priors: float) -> None:
-        self.is_expanded = True
-        self.child_priors = child_priors
+    def expand(self, node: int, child_priors: np.ndarray) -> None:
+        self.is_expanded[node] = True
+        self.child_priors[node] = child_priors
 
-    def maybe_add_child(self, move: int) -> 'UCTNode':
-        if move not in self.children:
-            rubiks_child = RubiksCube(cube=RubiksCube.from_one_hot_cube(self.game_state))
-            state_child, _, _, _ = rubiks_child.step(RubiksAction(rubiks_child.actions[move]))
-            self.children[move] = UCTNode(
-                game_state=rubiks_child.to_one_hot_cube(state_child), move=move,
-                actions_number=self.actions_number, parent=self
-            )
-        return self.children[move]
-
-    def backup(self, value_estimate: float) -> None:
-        current = self
-        while current.parent is not None:
-            current.total_value = max(value_estimate, current.total_value) + 1
-            current = current.parent
+    def backup(self, node: int, value_estimate: float) -> None:
+        current = node
+        while current >= 0:
+            parent = self.parents[current]
+            if parent < 0:
+                self.root_total_value = max(value_estimate, self.root_total_value) + 1
+            else:
+                move = self.parent_moves[current]
+                self.child_total_value[parent, move] = max(
+                    value_estimate, self.child_total_value[parent, move]
+                ) + 1
+            current = parent
 
 
 class MCTS:
@@ -103,27 +105,42 @@ class MCTS:
         :return None
         """
         self.adi_model = adi_model
-        self.main_node = None
+        self.tree = None
 
-    def search(self, rubiks, max_iterations) -> Optional[List]:
+    def search(self, rubiks, max_iterations, batch_size: int = 32) -> Optional[List]:
         """
         Actual resolution method for a given Rubik's cube object received
+        The virtual loss applied during leaf selection steers successive selections towards
+        distinct leaves, so batch_size leaves are collected per pass and evaluated by the
+        network in a single batched predict call; batch_size=1 recovers the sequential search
         :param rubiks: Rubiks's cube object to be resolved
         :param max_iterations: Number of tree explorations
+        :param batch_size: Number of parallel leaf selections per network evaluation
         :return None
         """
-        self.main_node = UCTNode(
-            rubiks.state_one_hot, move=None,
-            actions_number=len(rubiks.actions), parent=RootNode()
+        self.tree = UCTTree(
+            rubiks.state_one_hot, actions_number=len(rubiks.actions), max_nodes=max_iterations + 1
         )
-        for _ in range(max_iterations):
-            leaf, path = self.main_node.select_leaf()
-            value, policy = self.adi_model.model.predict(np.expand_dims(leaf.game_state, axis=0))
-            value, policy = np.asscalar(value), np.ravel(policy)
-            leaf.expand(policy)
-            leaf.backup(value)
-            if RubiksCube(cube=leaf.game_state).is_resolved():
-                return path
+        solved_one_hot = RubiksCube(dim=rubiks.dim).state_one_hot
+        iterations = 0
+        while iterations < max_iterations:
+            current_batch = min(batch_size, max_iterations - iterations)
+            leaves, paths = [], []
+            for _ in range(current_batch):
+                leaf, path = self.tree.select_leaf()
+                leaves.append(leaf)
+                paths.append(path)
+            values, policies = self.adi_model.model.predict(
+                self.tree.game_states[np.asarray(leaves)], batch_size=batch_size
+            )
+            values = np.ravel(values)
+            for leaf, value, policy in zip(leaves, values, policies):
+                self.tree.expand(leaf, policy)
+                self.tree.backup(leaf, float(value))
+            for leaf, path in zip(leaves, paths):
+                if np.array_equal(self.tree.game_states[leaf], solved_one_hot):
+                    return path
+            iterations += current_batch
         return None
 
     def score(self, shuffle_depth: int, resolutions_number: int, max_iterations: int) -> float:
@@ -40,6 +40,27 @@ class RubiksAction:
 
 
 class RubiksCube:
+    _cached_action_objects = None
+    _cached_inverse_action_indexes = None
+
+    @classmethod
+    def get_action_objects(cls):
+        if cls._cached_action_objects is None:
+            actions = [side+direction for side, direction in product(rc_conf.sides, rc_conf.directions)]
+            cls._cached_action_objects = [RubiksAction(action) for action in actions]
+        return cls._cached_action_objects
+
+    @classmethod
+    def get_inverse_action_indexes(cls):
+        if cls._cached_inverse_action_indexes is None:
+            action_objects = cls.get_action_objects()
+            index_actions = {str(action): index for index, action in enumerate(action_objects)}
+            cls._cached_inverse_action_indexes = np.array(
+                [index_actions[str(action.get_inverse_action())] for action in action_objects],
+                dtype=np.intp
+            )
+        return cls._cached_inverse_action_indexes
+
     def __init__(self, dim=3, cube=None, verbose=False, shuffle=False):
         self.colors = rc_conf.colors
         self.connexions = rc_conf.connexions
@@ -95,11 +116,10 @@ class RubiksCube:
     def get_action_from_two_states(state_1, state_2):
         assert isinstance(state_1, np.ndarray) and isinstance(state_2, np.ndarray)
         assert len(state_1.shape) == len(state_2.shape) == 3
-        rubiks_1 = RubiksCube(dim=state_1.shape[-1], cube=state_1)
-        for action in rubiks_1.actions:
-            rubiks_1_copy = RubiksCube(cube=rubiks_1.cube)
-            rubiks_action = RubiksAction(action)
-            new_state, _, _, _ = rubiks_1_copy.step(rubiks_action)
+        scratch = RubiksCube(dim=state_1.shape[-1])
+        for rubiks_action in RubiksCube.get_action_objects():
+            scratch.load_state(state_1)
+            new_state, _, _, _ = scratch.step(rubiks_action)
             if np.array_equal(new_state, state_2):
                 return rubiks_action
         return None
@@ -171,8 +191,9 @@ class RubiksCube:
         return 1 if resolved else -1
     
     def shuffle_cube(self, n=100):
+        action_objects = self.get_action_objects()
         for _ in range(n):
-            random_action = RubiksAction()
+            random_action = random.choice(action_objects)
             self._rotate(random_action.action, verbose=False)
             self.counter = 0
         if self.verbose:
@@ -180,13 +201,29 @@ class RubiksCube:
 
     def is_resolved(self):
         return True if self._get_reward() == 1 else False
+
+    def load_state(self, cube):
+        assert isinstance(cube, np.ndarray)
+        if cube.shape == self.cube.shape + (len(self.colors),):
+            cube = self.from_one_hot_cube(cube)
+        np.copyto(self.cube, cube)
+        self.counter = 0
     
     def reset(self, shuffle=True):
         self.cube = self._construct_cube()
         if shuffle:
             self.shuffle_cube()
         return self.cube
-            
+
+    def fast_step(self, move_idx):
+        permutation = get_face_permutations(self.dim)[move_idx]
+        self.cube = self.cube.reshape(-1)[permutation].reshape(self.cube.shape)
+        self.counter += 1
+        state = self.cube
+        reward = self._get_reward()
+        done = self.is_resolved()
+        return state, reward, done, None
+
     def step(self, action):
         assert isinstance(action, RubiksAction) and action.action is not None
         self._rotate(action.action, verbose=self.verbose)
@@ -232,3 +269,30 @@ class RubiksCube:
                 )
         ax._axis3don = False
         plt.show()
+
+
+_face_permutations = {}
+_one_hot_permutations = {}
+
+
+def get_face_permutations(dim=3):
+    if dim not in _face_permutations:
+        reference = RubiksCube(dim=dim)
+        state_size = reference.state.size
+        permutations = np.empty((len(reference.actions), state_size), dtype=np.intp)
+        for action_idx, action in enumerate(RubiksCube.get_action_objects()):
+            labeled = RubiksCube(dim=dim, cube=np.arange(state_size).reshape(reference.state.shape))
+            labeled.step(action)
+            permutations[action_idx] = labeled.state.reshape(-1)
+        _face_permutations[dim] = permutations
+    return _face_permutations[dim]
+
+
+def get_one_hot_permutations(dim=3):
+    if dim not in _one_hot_permutations:
+        permutations = get_face_permutations(dim)
+        colors_number = len(rc_conf.colors)
+        _one_hot_permutations[dim] = (
+            permutations[:, :, None] * colors_number + np.arange(colors_number)
+        ).reshape(permutations.shape[0], -1)
+    return _one_hot_permutations[dim]
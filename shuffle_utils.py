@@ -0,0 +1,91 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _mix_block_pair(X, weights, block_a, block_b, seed):
+    """
+    Swap a random half of the rows between two blocks, applying the same
+    row exchange to X and weights so their alignment is preserved
+    :param X: Samples array, shuffled along its first axis
+    :param weights: Weights array aligned with X
+    :param block_a: (start, stop) bounds of the first block
+    :param block_b: (start, stop) bounds of the second block
+    :param seed: Seed of the random generator local to this worker
+    :return: None
+    """
+    random_state = np.random.RandomState(seed)
+    start_a, stop_a = block_a
+    start_b, stop_b = block_b
+    swap_size = min(stop_a - start_a, stop_b - start_b) // 2
+    if swap_size == 0:
+        return
+    rows_a = start_a + random_state.choice(stop_a - start_a, size=swap_size, replace=False)
+    rows_b = start_b + random_state.choice(stop_b - start_b, size=swap_size, replace=False)
+    swapped = X[rows_a]
+    X[rows_a] = X[rows_b]
+    X[rows_b] = swapped
+    swapped_weights = weights[rows_a]
+    weights[rows_a] = weights[rows_b]
+    weights[rows_b] = swapped_weights
+
+
+def _shuffle_block(X, weights, start, stop, seed):
+    """
+    Shuffle one contiguous block of rows in place, applying the same
+    permutation to X and weights
+    :param X: Samples array, shuffled along its first axis
+    :param weights: Weights array aligned with X
+    :param start: First row of the block
+    :param stop: Row after the last row of the block
+    :param seed: Seed of the random generator local to this worker
+    :return: None
+    """
+    random_state = np.random.RandomState(seed)
+    indexes = np.arange(start, stop, dtype=np.intp)
+    random_state.shuffle(indexes)
+    X[start:stop] = X[indexes]
+    weights[start:stop] = weights[indexes]
+
+
+def threaded_block_shuffle(X, weights, n_threads=None, block_rows=65536):
+    """
+    In-place parallel shuffle of (X, weights) along their first axis
+    The arrays are partitioned into contiguous blocks; a first pass swaps random row
+    subsets between randomly paired blocks to mix rows across blocks, then every block
+    is permuted internally, both passes running on a thread pool with each worker
+    writing a disjoint row range. The result is an approximate uniform shuffle, which
+    is what randomizing training-sample order requires, at a fraction of the cost of a
+    single-threaded full gather on multi-GB arrays; works on memory-mapped arrays too
+    :param X: Samples array, shuffled along its first axis
+    :param weights: Weights array aligned with X, shuffled with the same permutation
+    :param n_threads: Size of the thread pool, defaults to the machine core count
+    :param block_rows: Number of rows per block, bounds per-worker scratch memory
+    :return: None
+    """
+    samples = len(X)
+    assert len(weights) == samples, "X and weights must have the same length"
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    blocks = [
+        (start, min(start + block_rows, samples)) for start in range(0, samples, block_rows)
+    ]
+    pair_order = np.random.permutation(len(blocks))
+    pairs = [
+        (blocks[pair_order[idx]], blocks[pair_order[idx + 1]])
+        for idx in range(0, len(blocks) - 1, 2)
+    ]
+    seeds = np.random.randint(0, 2 ** 31 - 1, size=len(pairs) + len(blocks))
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        mix_futures = [
+            executor.submit(_mix_block_pair, X, weights, block_a, block_b, seeds[idx])
+            for idx, (block_a, block_b) in enumerate(pairs)
+        ]
+        for future in mix_futures:
+            future.result()
+        shuffle_futures = [
+            executor.submit(_shuffle_block, X, weights, start, stop, seeds[len(pairs) + idx])
+            for idx, (start, stop) in enumerate(blocks)
+        ]
+        for future in shuffle_futures:
+            future.result()